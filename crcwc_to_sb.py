@@ -1,6 +1,63 @@
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import gzip
+import ijson
+from itertools import islice
+from lxml import etree
+from lxml import html as lxhtml
 import requests
+import requests_cache
+from requests_cache import DO_NOT_CACHE
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
+from typing import Optional, Union
+
+
+# Shared session so repeated calls to the CRC and Macrostrat services reuse pooled keep-alive connections.
+# Successful CRC report pages and Macrostrat points are also cached for a week in crcwc_to_sb.sqlite under the user
+# cache directory, so re-running a harvest doesn't re-download them. Nothing else, ArcGIS queries included, is cached.
+_TIMEOUT = (5, 30)
+_USER_AGENT = "ndc-experiment/crcwc_to_sb"
+
+# Retry policy shared by the requests adapters and the aiohttp fetches
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF = 0.5
+_RETRY_STATUSES = (429, 502, 503, 504)
+
+_SESSION = requests_cache.CachedSession(
+    "crcwc_to_sb",
+    use_cache_dir=True,
+    expire_after=DO_NOT_CACHE,
+    urls_expire_after={
+        "my.usgs.gov/arcgis/*": DO_NOT_CACHE,
+        "my.usgs.gov/crcwc/*": 7*86400,
+        "macrostrat.org/api/*": 7*86400
+    },
+    allowable_codes=(200,)
+)
+_SESSION.headers.update({"User-Agent": _USER_AGENT})
+
+# ArcGIS MapServer queries go through a plain session, since requests-cache reads whole bodies and would defeat streaming
+_AGS_SESSION = requests.Session()
+_AGS_SESSION.headers.update({"User-Agent": _USER_AGENT})
+
+
+def _pooled_adapter(pool_maxsize=32):
+    return HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=_RETRY_TOTAL, backoff_factor=_RETRY_BACKOFF, status_forcelist=_RETRY_STATUSES)
+    )
+
+
+for _prefix in ["https://my.usgs.gov", "https://macrostrat.org"]:
+    _SESSION.mount(_prefix, _pooled_adapter())
+_AGS_SESSION.mount("https://my.usgs.gov", _pooled_adapter())
 
 
 # Basic attempt at externalizing the mapping of esoteric source properties to common concepts
@@ -19,6 +76,73 @@ property_mapping = {
     }
 }
 
+# Tables in the CRC report pages, identified by their column labels
+target_schemas = {
+    "depth_age_formation": ['Min Depth', 'Max Depth', 'Age', 'Formation'],
+    "thin_sections": ['Sequence', 'Min Depth', 'Max Depth', 'View']
+}
+
+_LABELS_TO_SCHEMA = {tuple(v): k for k, v in target_schemas.items()}
+
+# Query parameters for the CRC Well Catalog MapServer layers; only the paging parameters change between calls
+_AGS_BASE_PARAMS = {
+    "where": "0=0",
+    "outFields": "*",
+    "returnGeometry": "true",
+    "returnIdsOnly": "false",
+    "returnCountOnly": "false",
+    "returnZ": "false",
+    "returnM": "false",
+    "returnDistinctValues": "false",
+    "returnExtentsOnly": "false",
+    "f": "geojson"
+}
+
+_REPORT_MARKER = b"report2"
+
+# Parser and compiled XPath expressions for walking the CRC report pages; these run inside libxml2
+_HTML_PARSER = lxhtml.HTMLParser(encoding="utf-8")
+_TABLES = etree.XPath("//table[contains(concat(' ', normalize-space(@class), ' '), ' report2 ')]")
+_LABELS = etree.XPath("(.//tr)[1]//td[contains(concat(' ', normalize-space(@class), ' '), ' label ')]")
+_ROWS = etree.XPath("(.//tr)[position() > 1]")
+_PHOTOS = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' report2 ')]//a[@title='see photo']/@href",
+    smart_strings=False
+)
+_DOCS = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' report2 ')]//a[@title='download analysis document']/@href",
+    smart_strings=False
+)
+
+# Contacts and provenance that are the same on every CRC item; these are shared between items, not copied
+_CONTACT_PREFIX = (
+    {
+        "name": "Core Research Center",
+        "oldPartyId": 17172,
+        "type": "Data Owner",
+        "contactType": "organization"
+    },
+    {
+        "name": "Jeannine Honey",
+        "oldPartyId": 4685,
+        "type": "Data Steward",
+        "contactType": "person"
+    }
+)
+
+_PROVENANCE = {"annotation": "Harvested from ArcGIS Server and Core Research Center Web Site"}
+
+# Fixed parts of the download web links for analysis documents and photos
+_DOC_TPL = {
+    "type": "download",
+    "typeLabel": "Download",
+    "rel": "related",
+    "hidden": False,
+    "itemWebLinkTypeId": "4f4e475de4b07f02db47dec0"
+}
+
+_PHOTO_TPL = {**_DOC_TPL, "typeLabel": "Photo"}
+
 
 def make_identifier(crc_record):
     return {
@@ -29,76 +153,200 @@ def make_identifier(crc_record):
         
 
 
-def crcwc_items(sample_type="core", record_count=1000, offset=0):
+def crcwc_query_url(sample_type="core"):
     if sample_type == "core":
         layer = 0
     elif sample_type == "cutting":
         layer = 1
 
-    params = [
-        "where=0%3D0",
-        "outFields=*",
-        "returnGeometry=true",
-        "returnIdsOnly=false",
-        "returnCountOnly=false",
-        "returnZ=false",
-        "returnM=false",
-        "returnDistinctValues=false",
-        f"resultOffset={offset}",
-        f"resultRecordCount={record_count}",
-        "returnExtentsOnly=false",
-        "f=geojson"
-    ]
+    return f"https://my.usgs.gov/arcgis/rest/services/crcwc/crcwc/MapServer/{layer}/query"
+
+
+def crcwc_query_params(record_count=1000, offset=0):
+    return {**_AGS_BASE_PARAMS, "resultOffset": offset, "resultRecordCount": record_count}
+
 
-    ags_url = f"https://my.usgs.gov/arcgis/rest/services/crcwc/crcwc/MapServer/{layer}/query?{'&'.join(params)}"
+def crcwc_items(sample_type="core", record_count=1000, offset=0):
+    ags_url = crcwc_query_url(sample_type)
     
-    response = requests.get(ags_url).json()
+    response = orjson.loads(_AGS_SESSION.get(ags_url, params=crcwc_query_params(record_count, offset), timeout=_TIMEOUT).content)
     
     return response
 
 
-def extract_crc_data(crcid, sample_type="core"):
-    target_schemas = {
-        "depth_age_formation": ['Min Depth', 'Max Depth', 'Age', 'Formation'],
-        "thin_sections": ['Sequence', 'Min Depth', 'Max Depth', 'View']
-    }
-    
-    url = f"https://my.usgs.gov/crcwc/{sample_type}/report/{crcid}"
-    
-    r = requests.get(url)
-    
-    soup = BeautifulSoup(r.content, "html.parser")
+def iter_crcwc_features(sample_type="core", page_size=1000):
+    # Yields features one at a time, decoding each page incrementally rather than holding it all in memory
+    ags_url = crcwc_query_url(sample_type)
+    offset = 0
+    while True:
+        feature_count = 0
+        page_keys = dict()
+        with _AGS_SESSION.get(ags_url, params=crcwc_query_params(page_size, offset), stream=True, timeout=_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            events = _watch_page_keys(ijson.parse(response.raw, use_float=True), page_keys)
+            for feature in ijson.items(events, "features.item"):
+                feature_count += 1
+                yield feature
+
+        # ArcGIS reports errors as HTTP 200 with an error object, which must not be mistaken for the end of the data
+        if "error" in page_keys or "features" not in page_keys:
+            raise ValueError(
+                f"ArcGIS query for {sample_type} failed at offset {offset}: {page_keys.get('error', 'no features in response')}"
+            )
+
+        if feature_count == 0:
+            break
+
+        offset += feature_count
+
+
+def _watch_page_keys(events, page_keys):
+    # Passes ijson events through, noting the top-level keys of the page and any error message
+    for prefix, event, value in events:
+        if prefix == "" and event == "map_key":
+            page_keys.setdefault(value, None)
+        elif prefix == "error.message":
+            page_keys["error"] = value
+        yield prefix, event, value
+
+
+def crcwc_count(sample_type="core"):
+    params = {**_AGS_BASE_PARAMS, "returnCountOnly": "true", "f": "json"}
+
+    r = _AGS_SESSION.get(crcwc_query_url(sample_type), params=params, timeout=_TIMEOUT)
+    r.raise_for_status()
+    response = orjson.loads(r.content)
+
+    if "count" not in response:
+        raise ValueError(f"ArcGIS count query for {sample_type} returned no count: {response}")
+
+    return response["count"]
+
+
+def iter_all_crcwc(sample_type="core", page_size=1000, workers=8):
+    # Once the total is known the pages are independent, so fetch them on a thread pool; features still come out in order.
+    # At most `workers` pages are in flight or waiting on the consumer at any time.
+    ags_url = crcwc_query_url(sample_type)
+    total = crcwc_count(sample_type)
+    offsets = iter(range(0, total, page_size))
+
+    # A session of its own, with a connection pool sized to the thread pool so no worker's connection gets discarded
+    session = requests.Session()
+    session.headers.update({"User-Agent": _USER_AGENT})
+    for prefix in ["https://", "http://"]:
+        session.mount(prefix, _pooled_adapter(pool_maxsize=workers))
+
+    def fetch_page(offset):
+        response = session.get(ags_url, params=crcwc_query_params(page_size, offset), timeout=_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    executor = ThreadPoolExecutor(workers)
+    pending = deque()
+    try:
+        for offset in islice(offsets, workers):
+            pending.append((offset, executor.submit(fetch_page, offset)))
+
+        while pending:
+            offset, future = pending.popleft()
+            page = orjson.loads(future.result())
+
+            # ArcGIS reports errors as HTTP 200 with an error object
+            if "error" in page or "features" not in page:
+                error = page.get("error")
+                raise ValueError(
+                    f"ArcGIS query for {sample_type} failed at offset {offset}: "
+                    f"{error.get('message', error) if isinstance(error, dict) else 'no features in response'}"
+                )
+            features = page["features"]
+
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append((next_offset, executor.submit(fetch_page, next_offset)))
+
+            # A short page means the layer's maxRecordCount is below page_size, and records would be skipped
+            expected = min(page_size, total - offset)
+            if len(features) < expected:
+                raise ValueError(
+                    f"ArcGIS returned {len(features)} {sample_type} features at offset {offset}, expected {expected}; "
+                    "page_size is probably larger than the layer's maxRecordCount"
+                )
+
+            yield from features
+    finally:
+        # Also runs when the consumer stops early, so don't wait on pages nobody will read
+        executor.shutdown(wait=False, cancel_futures=True)
+        session.close()
+
+
+async def _fetch(session, url, **kw):
+    # Mirrors the requests adapters: retry connection errors and retryable statuses with backoff, raise on anything else
+    for attempt in range(_RETRY_TOTAL + 1):
+        try:
+            async with session.get(url, **kw) as response:
+                if response.status not in _RETRY_STATUSES or attempt == _RETRY_TOTAL:
+                    response.raise_for_status()
+                    return await response.read()
+        except aiohttp.ClientConnectionError:
+            if attempt == _RETRY_TOTAL:
+                raise
+
+        await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
+
+
+def crc_report_url(crcid: Union[int, str], sample_type: str = "core") -> str:
+    return f"https://my.usgs.gov/crcwc/{sample_type}/report/{crcid}"
+
+
+def extract_crc_data(crcid: Union[int, str], sample_type: str = "core") -> Optional[dict]:
+    r = _SESSION.get(crc_report_url(crcid, sample_type), timeout=_TIMEOUT)
+
+    return parse_crc_report(r.content)
+
+
+async def extract_crc_data_async(session, crcid, sample_type="core"):
+    content = await _fetch(session, crc_report_url(crcid, sample_type))
+
+    # Parsing is CPU bound, so keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, parse_crc_report, content)
+
+
+def parse_crc_report(content: bytes) -> Optional[dict]:
+    # Pages without any report2 table or section have nothing to extract, so skip building a tree for them
+    if _REPORT_MARKER not in content:
+        return None
+
+    doc = lxhtml.fromstring(content, parser=_HTML_PARSER)
     
-    data_structures = dict()
-    for index, table in enumerate(soup.findAll("table",{"class":"report2"})):
-        first_row = table.find("tr")
-        labels = [i.text for i in first_row.findAll("td", {"class": "label"})]
-        target_data = list(target_schemas.keys())[list(target_schemas.values()).index(labels)]
+    data_structures: dict = dict()
+    for table in _TABLES(doc):
+        labels = [i.text_content() for i in _LABELS(table)]
+        target_data = _LABELS_TO_SCHEMA.get(tuple(labels))
+        if target_data is None:
+            continue
         data_structures[target_data] = list()
 
-        for row in [r for r in table.findAll("tr")][1:]:
+        for row in _ROWS(table):
             d_this = dict()
-            for i, col in enumerate(row.findAll("td")):
-                anchor = col.find("a")
-                if anchor:
+            for i, col in enumerate(row.iter("td")):
+                anchor = col.find(".//a")
+                if anchor is not None:
                     this_data = anchor.get("href")
                 else:
-                    this_data = col.text
+                    this_data = col.text_content()
                 d_this[labels[i]] = this_data
             data_structures[target_data].append(d_this)
 
-    photos = list()
-    documents = list()
-
-    for section in soup.findAll("div",{"class":"report2"}):
-        photos.extend(list(set([i.get('href') for i in section.findAll("a",{"title":"see photo"})])))
-        documents.extend(list(set([i.get('href') for i in section.findAll("a",{"title":"download analysis document"})])))
+    # Dicts rather than sets, so duplicates are dropped but links keep their page order from one run to the next
+    photos = dict.fromkeys(_PHOTOS(doc))
+    documents = dict.fromkeys(_DOCS(doc))
         
-    if len(photos) > 0:
-        data_structures["photos"] = photos
+    if photos:
+        data_structures["photos"] = list(photos)
         
-    if len(documents) > 0:
-        data_structures["documents"] = documents
+    if documents:
+        data_structures["documents"] = list(documents)
         
     if not data_structures:
         return None
@@ -114,58 +362,48 @@ def crc_title(sample_type, source_identifier):
     return f'Core Research Center {sample_type.capitalize()} {source_identifier}'
 
 
-def crc_body(sample_type, crc_record, additional_props, macrostrat_info):
-    body_string = f'<p>Core Research Center, {sample_type} {crc_record[property_mapping[sample_type]["source_identifier"]]}, from well operated by {crc_record[property_mapping[sample_type]["site_operator"]]}</p>'
-    body_string+=f"<h4>Properties from ArcGIS MapServer</h4>"
+def crc_body(sample_type: str, crc_record: dict, additional_props: Optional[list], macrostrat_info: Optional[dict]) -> str:
+    mapping = property_mapping[sample_type]
 
-    body_string+="<div>"
-    body_string+=json.dumps(crc_record)
-    body_string+="</div>"
+    parts = [
+        f'<p>Core Research Center, {sample_type} {crc_record[mapping["source_identifier"]]}, from well operated by {crc_record[mapping["site_operator"]]}</p>',
+        "<h4>Properties from ArcGIS MapServer</h4>",
+        "<div>",
+        orjson.dumps(crc_record).decode(),
+        "</div>"
+    ]
 
     if additional_props is not None:
-        body_string+=f"<h4>Properties from Web Page</h4>"
-        body_string+="<div>"
-        body_string+=json.dumps(additional_props)
-        body_string+="</div>"
+        parts.append("<h4>Properties from Web Page</h4>")
+        parts.append("<div>")
+        parts.append(orjson.dumps(additional_props).decode())
+        parts.append("</div>")
     
     if macrostrat_info is not None:
-        body_string+=f"<h4>Geologic Map Information from Macrostrat</h4>"
-        body_string+="<div>"
-        body_string+=json.dumps(macrostrat_info)
-        body_string+="</div>"
+        parts.append("<h4>Geologic Map Information from Macrostrat</h4>")
+        parts.append("<div>")
+        parts.append(orjson.dumps(macrostrat_info).decode())
+        parts.append("</div>")
 
-    return body_string
+    return "".join(parts)
 
 
 def crc_contacts(site_operator):
-    contacts = [
-        {
-            "name": "Core Research Center",
-            "oldPartyId": 17172,
-            "type": "Data Owner",
-            "contactType": "organization"
-        },
-        {
-            "name": "Jeannine Honey",
-            "oldPartyId": 4685,
-            "type": "Data Steward",
-            "contactType": "person"
-        },
+    return [
+        *_CONTACT_PREFIX,
         {
             "name": site_operator,
             "type": "Site Operator",
             "contactType": "organization"
         }
     ]
-    
-    return contacts
 
 
 def crc_provenance():
-    return {"annotation": "Harvested from ArcGIS Server and Core Research Center Web Site"}
+    return _PROVENANCE
 
 
-def crc_identifiers(identifier, sample_type, crc_record):
+def crc_identifiers(identifier: Union[int, str], sample_type: str, crc_record: dict) -> list:
     identifiers = [
         {
             "type": "uniqueKey",
@@ -173,30 +411,34 @@ def crc_identifiers(identifier, sample_type, crc_record):
             "key": identifier
         }
     ]
+
+    mapping = property_mapping[sample_type]
+    library_number = crc_record[mapping["source_identifier"]]
+    api_number = crc_record[mapping["api_identifier"]]
     
-    if crc_record[property_mapping[sample_type]["source_identifier"]] is not None:
+    if library_number is not None:
         identifiers.append({
             "type": "uniqueKey",
             "scheme": "CRC Library Number",
-            "key": crc_record[property_mapping[sample_type]["source_identifier"]]
+            "key": library_number
         })
 
-    if crc_record[property_mapping[sample_type]["api_identifier"]] is not None:
+    if api_number is not None:
         identifiers.append({
             "type": "uniqueKey",
             "scheme": "American Petroleum Institute Number",
-            "key": crc_record[property_mapping[sample_type]["api_identifier"]]
+            "key": api_number
         })
     
     return identifiers
 
 
-def crc_weblinks(sample_type, identifier, extracted_data=None):
+def crc_weblinks(sample_type: str, identifier: Union[int, str], extracted_data: Optional[dict] = None) -> list:
     web_links = [
         {
             "type": "webLink",
             "typeLabel": "Web Link",
-            "uri": f"https://my.usgs.gov/crcwc/{sample_type}/report/{identifier}",
+            "uri": crc_report_url(identifier, sample_type),
             "rel": "related",
             "title": "Core Research Center Well Catalog Web Page",
             "hidden": False,
@@ -205,33 +447,14 @@ def crc_weblinks(sample_type, identifier, extracted_data=None):
     ]
     
     if extracted_data is not None:
-        if "documents" in extracted_data.keys():
-            for doc_link in extracted_data["documents"]:
-                web_links.append(
-                    {
-                        "type": "download",
-                        "typeLabel": "Download",
-                        "uri": doc_link,
-                        "rel": "related",
-                        "title": f"Core Research Center Analysis File {doc_link.split('/')[-1]}",
-                        "hidden": False,
-                        "itemWebLinkTypeId": "4f4e475de4b07f02db47dec0"
-                    }
-                )
-
-        if "photos" in extracted_data.keys():
-            for doc_link in extracted_data["photos"]:
-                web_links.append(
-                    {
-                        "type": "download",
-                        "typeLabel": "Photo",
-                        "uri": doc_link,
-                        "rel": "related",
-                        "title": f"Core Research Center Photo {doc_link.split('/')[-1]}",
-                        "hidden": False,
-                        "itemWebLinkTypeId": "4f4e475de4b07f02db47dec0"
-                    }
-                )
+        web_links.extend(
+            {**_DOC_TPL, "uri": u, "title": f"Core Research Center Analysis File {u.rsplit('/', 1)[-1]}"}
+            for u in extracted_data.get("documents", ())
+        )
+        web_links.extend(
+            {**_PHOTO_TPL, "uri": u, "title": f"Core Research Center Photo {u.rsplit('/', 1)[-1]}"}
+            for u in extracted_data.get("photos", ())
+        )
     
     return web_links
 
@@ -245,37 +468,37 @@ def crc_location(crc_record):
 
 
 def crc_tags(macrostrat_info):
-    tags = list()
-    
-    if macrostrat_info["rocktype"][0] is not None:
-        for rock_type in macrostrat_info["rocktype"]:
-            tags.append(
-                {
-                    "type": "Theme",
-                    "scheme": "Rock Type",
-                    "name": rock_type[0:80]
-                }
-            )
+    rocks = macrostrat_info.get("rocktype") or ()
+    age = macrostrat_info.get("age")
+    name = macrostrat_info.get("name")
+
+    if not (rocks or age or name):
+        return None
+
+    if rocks and rocks[0] is not None:
+        tags = [{"type": "Theme", "scheme": "Rock Type", "name": r[:80]} for r in rocks]
+    else:
+        tags = []
         
-    if len(macrostrat_info["age"]) > 0:
+    if age:
         tags.append(
             {
                 "type": "Theme",
                 "scheme": "Geologic Age",
-                "name": macrostrat_info["age"][0:80]
+                "name": age[:80]
             }
         )
 
-    if len(macrostrat_info["name"]) > 0:
+    if name:
         tags.append(
             {
                 "type": "Theme",
                 "scheme": "Geologic Formation",
-                "name": macrostrat_info["name"][0:80]
+                "name": name[:80]
             }
         )
 
-    if len(tags) == 0:
+    if not tags:
         return None
     
     return tags
@@ -284,18 +507,81 @@ def crc_tags(macrostrat_info):
 def sb_item_from_crcwc(sample_type, crc_record, additional_props=None, macrostrat_info=None):
     extracted_data = extract_crc_data(crc_record["id"], sample_type)
 
-    if extracted_data is not None and "depth_age_formation" in extracted_data.keys():
+    lat, lng = crc_record["properties"]["lat"], crc_record["properties"]["lng"]
+    if isinstance(lat, float) and isinstance(lng, float):
+        macrostrat_info = macrostrat_context(lat=lat, lng=lng)
+
+    return assemble_sb_item(sample_type, crc_record, extracted_data, additional_props, macrostrat_info)
+
+
+async def sb_item_from_crcwc_async(session, semaphore, sample_type, crc_record, additional_props=None, macrostrat_info=None, macrostrat_tasks=None):
+    async with semaphore:
+        lookups = [extract_crc_data_async(session, crc_record["id"], sample_type)]
+
+        lat, lng = crc_record["properties"]["lat"], crc_record["properties"]["lng"]
+        if isinstance(lat, float) and isinstance(lng, float):
+            lookups.append(macrostrat_context_async(session, lat=lat, lng=lng, tasks=macrostrat_tasks))
+
+        # The CRC report page and the Macrostrat point lookup are independent, so run them together
+        results = await asyncio.gather(*lookups)
+
+    extracted_data = results[0]
+    if len(results) > 1:
+        macrostrat_info = results[1]
+
+    return assemble_sb_item(sample_type, crc_record, extracted_data, additional_props, macrostrat_info)
+
+
+async def sb_items_from_crcwc_async(sample_type, crc_records, concurrency=16):
+    semaphore = asyncio.Semaphore(concurrency)
+    # Macrostrat lookups by grid cell for this run only, so records in the same cell wait on one in-flight request
+    macrostrat_tasks = dict()
+
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32),
+        headers={"User-Agent": _USER_AGENT},
+        timeout=aiohttp.ClientTimeout(sock_connect=_TIMEOUT[0], sock_read=_TIMEOUT[1])
+    ) as session:
+        return await asyncio.gather(
+            *[
+                sb_item_from_crcwc_async(session, semaphore, sample_type, crc_record, macrostrat_tasks=macrostrat_tasks)
+                for crc_record in crc_records
+            ],
+            return_exceptions=True
+        )
+
+
+def sb_items_from_crcwc(sample_type, crc_records, concurrency=16):
+    # Returns one entry per record, in order, with an exception object in place of any record that failed
+    return asyncio.run(sb_items_from_crcwc_async(sample_type, crc_records, concurrency))
+
+
+def sb_items_stream(sample_type, out_path):
+    # Writes one SB item per line (NDJSON) as records are harvested, gzipped if out_path ends in .gz.
+    # Memory is bounded by one item, the ijson parser state for the current ArcGIS page and the Macrostrat cell cache.
+    if out_path.endswith(".gz"):
+        f = gzip.open(out_path, "wb", compresslevel=1)
+    else:
+        f = open(out_path, "wb")
+
+    with f:
+        for feature in iter_crcwc_features(sample_type):
+            f.write(orjson.dumps(sb_item_from_crcwc(sample_type, feature), option=orjson.OPT_APPEND_NEWLINE))
+
+
+def assemble_sb_item(sample_type, crc_record, extracted_data, additional_props=None, macrostrat_info=None):
+    if extracted_data is not None and "depth_age_formation" in extracted_data:
         additional_props = extracted_data["depth_age_formation"]
 
-    if isinstance(crc_record["properties"]["lat"], float) and isinstance(crc_record["properties"]["lng"], float):
-        macrostrat_info = macrostrat_context(lat=crc_record["properties"]["lat"], lng=crc_record["properties"]["lng"])
+    mapping = property_mapping[sample_type]
+    properties = crc_record["properties"]
 
     sb_item = {
-        "parentId": property_mapping[sample_type]["parent_id"],
-        "identifiers": crc_identifiers(crc_record["id"], sample_type, crc_record["properties"]),
-        "title": crc_title(sample_type, crc_record["properties"][property_mapping[sample_type]["source_identifier"]]),
-        "body": crc_body(sample_type, crc_record["properties"], additional_props, macrostrat_info),
-        "contacts": crc_contacts(crc_record["properties"][property_mapping[sample_type]["site_operator"]]),
+        "parentId": mapping["parent_id"],
+        "identifiers": crc_identifiers(crc_record["id"], sample_type, properties),
+        "title": crc_title(sample_type, properties[mapping["source_identifier"]]),
+        "body": crc_body(sample_type, properties, additional_props, macrostrat_info),
+        "contacts": crc_contacts(properties[mapping["site_operator"]]),
         "provenance": crc_provenance(),
         "browseCategories": ["Physical Item"],
         "webLinks": crc_weblinks(sample_type, crc_record["id"], extracted_data)
@@ -313,11 +599,45 @@ def sb_item_from_crcwc(sample_type, crc_record, additional_props=None, macrostra
 
 
 def macrostrat_context(lat, lng):
+    # Geologic map units vary slowly in space, so wells are bucketed to a ~1 km grid (2 decimal places) and share one lookup
+    return _macrostrat_context(round(lat, 2), round(lng, 2))
+
+
+@functools.lru_cache(maxsize=20_000)
+def _macrostrat_context(lat, lng):
     api = f"https://macrostrat.org/api/mobile/point?lat={lat}&lng={lng}"
     
-    r = requests.get(api, headers={"accept": "application/json"}).json()
+    r = orjson.loads(_SESSION.get(api, headers={"accept": "application/json"}, timeout=_TIMEOUT).content)
     
+    return macrostrat_data(r)
+
+
+async def macrostrat_context_async(session, lat, lng, tasks=None):
+    cell = (round(lat, 2), round(lng, 2))
+
+    # tasks maps grid cells to lookups already started in this event loop; without it every call does its own lookup
+    if tasks is None:
+        return await _macrostrat_context_async(session, *cell)
+
+    # No await between the check and the insert, so this is atomic on the event loop without a lock
+    task = tasks.get(cell)
+    if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+        task = asyncio.ensure_future(_macrostrat_context_async(session, *cell))
+        tasks[cell] = task
+
+    return await asyncio.shield(task)
+
+
+async def _macrostrat_context_async(session, lat, lng):
+    api = f"https://macrostrat.org/api/mobile/point?lat={lat}&lng={lng}"
+
+    r = orjson.loads(await _fetch(session, api, headers={"accept": "application/json"}))
+
+    return macrostrat_data(r)
+
+
+def macrostrat_data(r):
     if "success" in r.keys() and "data" in r["success"].keys():
         return r["success"]["data"]
     
-    return None
\ No newline at end of file
+    return None